@@ -1,9 +1,26 @@
 import yfinance as yf
 import pandas as pd
 import numpy as np
+import math
+import os
+import pickle
 import re
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from statistics import NormalDist
 from colorama import Fore, Style, init
-import scipy.stats
+
+CACHE_DIR = Path.home() / ".cache" / "risk_ranger"
+CACHE_TTL = 24 * 60 * 60  # downloads are refreshed once a day
+
+# Precision of the price, return and moment arrays used by every metric
+METRICS_DTYPE = np.float64
+
+_PERIOD_RE = re.compile(r"\d*(d|mo|y|max)")
+_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2} to \d{4}-\d{2}-\d{2}")
 
 # comment code
 
@@ -21,34 +38,83 @@ def print_banner():
     """
     print(Fore.WHITE + banner_text + Style.RESET_ALL)
 
-def get_approximate_period(ticker):
+def load_cached(name, fetch):
+    """
+    This function returns the data pickled under the given name if it is less than a day old.
+    Otherwise it calls fetch() and caches the result, unless it came back empty or NaN.
+    """
+    path = CACHE_DIR / (re.sub(r"[^\w.=-]", "_", name) + ".pkl")
+    if path.exists() and time.time() - path.stat().st_mtime < CACHE_TTL:
+        try:
+            return pd.read_pickle(path)
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError):
+            # Unreadable cache entry, fall through and download again
+            pass
+    data = fetch()
+    missing = data.empty if isinstance(data, pd.DataFrame) else pd.isna(data)
+    if not missing:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file and move it into place, so readers never see a partial pickle
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    return data
+
+def cached_download(ticker, **kwargs):
+    """
+    This function wraps yf.download with the on-disk cache, keyed by ticker and arguments.
+    Repeated runs on the same ticker and period skip the network entirely.
+    Only the Close column is kept, which is all the metrics need.
+    """
+    name = "_".join([ticker] + [f"{key}={value}" for key, value in sorted(kwargs.items())])
+    return load_cached(name, lambda: yf.download(ticker, actions=False, progress=False, **kwargs)[['Close']])
+
+def run_in_background(fetch):
+    """
+    This function calls fetch() on a daemon thread and returns a Future for its result.
+    A ThreadPoolExecutor worker is joined at interpreter exit even after shutdown(wait=False),
+    so an error or Ctrl-C in the prompts would hang until the download finished.
+    """
+    future = Future()
+    def worker():
+        try:
+            future.set_result(fetch())
+        except BaseException as exc:
+            future.set_exception(exc)
+    threading.Thread(target=worker, daemon=True).start()
+    return future
+
+def get_approximate_period(ticker, auto_adjust):
     """
     This function prompts the user to input an approximate period.
     """
-    period_regex = r"^\d*(d|mo|y|max)$"
     while True:
         period = input("Enter the period (e.g. XXd, XXmo, XXy, max): ")
-        if re.match(period_regex, period):
-            prices = yf.download(ticker, period=period)
+        if _PERIOD_RE.fullmatch(period):
+            prices = cached_download(ticker, period=period, auto_adjust=auto_adjust)
             if not prices.empty:
                 return prices, period
         print(Fore.RED + "Invalid period format. Here is an example: 10y" + Style.RESET_ALL)
 
-def get_specific_period(ticker):
+def get_specific_period(ticker, auto_adjust):
     """
     This function prompts the user to input a specific date range.
     """
-    date_regex = r"^\d{4}-\d{2}-\d{2} to \d{4}-\d{2}-\d{2}$"
     while True:
         date_range = input("Enter the period (e.g. yyyy-mm-dd to yyyy-mm-dd): ")
-        if re.match(date_regex, date_range):
+        if _DATE_RE.fullmatch(date_range):
             start_date, end_date = date_range.split(" to ")
-            prices = yf.download(ticker, start=start_date, end=end_date)
+            prices = cached_download(ticker, start=start_date, end=end_date, auto_adjust=auto_adjust)
             if not prices.empty:
                 return prices, f"{start_date} to {end_date}"
         print(Fore.RED + "Invalid date range format. Here is an example: 2021-01-01 to 2021-12-31" + Style.RESET_ALL)
 
-def get_valid_data(ticker):
+def get_valid_data(ticker, auto_adjust):
     """
     This function prompts the user to choose between an approximate period or a specific period
     and returns the downloaded stock data and the chosen period.
@@ -57,61 +123,80 @@ def get_valid_data(ticker):
         print("Would you like to get metrics using an approximate period from now (1) or input a specific period (2)?")
         choice = input("Enter 1 or 2: ")
         if choice == '1':
-            return get_approximate_period(ticker)
+            return get_approximate_period(ticker, auto_adjust)
         elif choice == '2':
-            return get_specific_period(ticker)
+            return get_specific_period(ticker, auto_adjust)
         print(Fore.RED + "Invalid choice. Please enter 1 or 2." + Style.RESET_ALL)
 
-def fetch_stock_data(prices):
+def fetch_stock_data(ticker):
     """
     This function fetches stock data using yfinance.
-    The user chooses either price returns or total returns.
-    It returns a DataFrame or Series of prices.
+    The user chooses either price returns or total returns before anything is downloaded,
+    so only the Close prices needed for that choice are requested.
+    It returns a Series of prices and the chosen period.
     """
     while True:
         choice = input("Choose 1 for price returns or 2 for total returns: ")
-        #Return price returns (Close prices), which does not include dividends
+        #Return price returns (raw Close prices), which does not include dividends
         if choice == '1':
-            close_prices = prices['Close']
+            auto_adjust = False
             break
-        # Return total returns (Adjusted Close prices), automatically includes dividends
+        # Return total returns (Close prices adjusted by yfinance), automatically includes dividends
         elif choice == '2':
-            close_prices = prices['Adj Close']
+            auto_adjust = True
             break
         else:
             print(Fore.RED + "Invalid choice, please enter 1 or 2." + Style.RESET_ALL)
-    return close_prices
+    prices, period = get_valid_data(ticker, auto_adjust)
+    close_prices = prices['Close']
+    # Recent yfinance versions keep a ticker level in the columns, even for a single ticker
+    if isinstance(close_prices, pd.DataFrame):
+        close_prices = close_prices.iloc[:, 0]
+    # Drop missing prices once, so no NaN reaches the array-based metrics
+    close_prices = close_prices.dropna()
+    return close_prices, period
 
 def calculate_total_return(prices):
     """
     This function calculates the total return over the period.
     It returns the total return as a single percentage.
     """
-    total_return = (prices.iloc[-1] / prices.iloc[0]) - 1
+    a = np.asarray(prices, dtype=METRICS_DTYPE)
+    total_return = float(a[-1]) / float(a[0]) - 1
     return total_return * 100
 
 def get_daily_returns(prices):
     """
     This function calculates the percentage change of the stock prices.
-    It returns a DataFrame with the percentage change.
+    It returns an array with the percentage change, one shorter than the prices.
     """
-    r = prices.pct_change().dropna() * 100
+    a = np.asarray(prices, dtype=METRICS_DTYPE)
+    # Work in place so only the output array is allocated
+    r = np.divide(a[1:], a[:-1])
+    r -= 1.0
+    r *= 100.0
     return r
 
-def standard_deviation(r):
-    return r.std(ddof=0)
-
-def skewness(r):
-    deviations_returns = r - r.mean()
-    std_returns = r.std(ddof=0)
-    cubed_deviations = (deviations_returns ** 3).mean()
-    return cubed_deviations / (std_returns ** 3)
-
-def kurtosis(r):
-    deviations_returns = r - r.mean()
-    std_returns = r.std(ddof=0)
-    exp4_deviations = (deviations_returns ** 4).mean()
-    return exp4_deviations / (std_returns ** 4)
+def _moments(r):
+    """
+    This function computes the mean, standard deviation (ddof=0), skewness and kurtosis in one go.
+    The squared deviations are reused for the third and fourth moments, and dot products
+    reduce them without allocating the cubed and fourth-power arrays.
+    """
+    a = np.ascontiguousarray(r, dtype=METRICS_DTYPE)
+    n = a.size
+    m = a.mean()
+    d = a - m
+    d2 = d * d
+    m2 = d2.sum() / n
+    m3 = d2.dot(d) / n
+    m4 = d2.dot(d2) / n
+    # Plain floats keep the scalar arithmetic downstream out of NumPy's dispatch
+    m, m2, m3, m4 = float(m), float(m2), float(m3), float(m4)
+    # Flat prices or a single return leave no variance, so the shape moments are undefined
+    if m2 == 0:
+        return m, 0.0, math.nan, math.nan
+    return m, math.sqrt(m2), m3 / m2 ** 1.5, m4 / m2 ** 2
 
 def get_level():
     """
@@ -126,111 +211,176 @@ def get_level():
         else:
             print(Fore.RED + "Invalid choice, please enter a valid integer." + Style.RESET_ALL)
 
-def var_historic(r, level):
+def var_historic_sorted(s, level):
+    """
+    This function calculates the historical VaR from returns already sorted in ascending order.
+    The percentile is interpolated linearly like np.percentile, but needs no pass over the returns.
+    Levels outside [0, 100] give NaN, like the Cornish-Fisher VaR.
+    """
+    if not 0 <= level <= 100:
+        return math.nan
+    position = level / 100 * (s.size - 1)
+    k = int(position)
+    threshold = s[k]
+    if k + 1 < s.size:
+        threshold += (position - k) * (s[k + 1] - s[k])
+    return -threshold
+
+def cvar_historic_sorted(s, level):
     """
-    This function calculates the historical Value at Risk (VaR) at the given confidence level.
+    This function calculates the CVaR from returns already sorted in ascending order.
+    The lower tail is a prefix of the sorted returns, found by binary search.
     """
-    return -np.percentile(r, level)
+    var = var_historic_sorted(s, level)
+    if math.isnan(var):
+        return math.nan
+    n_tail = np.searchsorted(s, -var, side='right')
+    return -s[:n_tail].mean()
 
-def cvar_historic(r, level):
+def _norm_ppf(p):
     """
-    This function calculates the Conditional Value at Risk (CVaR) at the given confidence level.
+    Gaussian quantile of p, returning -inf/inf at 0/1 and NaN outside [0, 1] like scipy.stats.norm.ppf.
     """
-    is_beyond = r <= -var_historic(r, level=level)
-    return -r[is_beyond].mean()
+    if 0 < p < 1:
+        return NormalDist().inv_cdf(p)
+    if p == 0:
+        return -math.inf
+    if p == 1:
+        return math.inf
+    return math.nan
 
-def var_cornishfisher(r, level):
+def _cornish_fisher_z(z, s, k):
+    """
+    Adjusts the gaussian quantile z for the skewness s and kurtosis k of the distribution.
+    """
+    z2 = z * z
+    z3 = z2 * z
+    return (z +
+            (z2 - 1) * s / 6 +
+            (z3 - 3 * z) * (k - 3) / 24 -
+            (2 * z3 - 5 * z) * (s * s) / 36
+            )
+
+def var_cornishfisher(r, level, moments=None):
     """
     Cornish-Fisher VaR, semi-gaussian modified with actual skewness & kurtosis of the distribution.
+    Pass the result of _moments(r) as moments to avoid computing them again.
     """
-    z = scipy.stats.norm.ppf(level / 100)
-    s = skewness(r)
-    k = kurtosis(r)
-    z = (z +
-         (z**2 - 1) * s / 6 +
-         (z**3 - 3 * z) * (k - 3) / 24 -
-         (2 * z**3 - 5 * z) * (s**2) / 36
-         )
-    return -(r.mean() + z * r.std(ddof=0))
+    z = _norm_ppf(level / 100)
+    m, sd, s, k = _moments(r) if moments is None else moments
+    return -(m + _cornish_fisher_z(z, s, k) * sd)
 
-def get_max_drawdown(prices: pd.Series):
+def get_max_drawdown(prices: np.ndarray, dates: pd.Index):
     """
-    Takes a time series of asset prices.
+    Takes an array of asset prices and the matching dates.
     Returns the maximum drawdown and its date.
     """
-    # Calculate wealth index
-    wealth_index = prices / prices.iloc[0]
+    # Drawdowns are scale invariant, so the wealth index is not needed
+    a = np.asarray(prices, dtype=METRICS_DTYPE)
     
     # Calculate previous peaks
-    previous_peaks = wealth_index.cummax()
-    
-    # Calculate drawdowns
-    drawdowns = (wealth_index - previous_peaks) / previous_peaks
+    previous_peaks = np.maximum.accumulate(a)
     
-    # Find the maximum drawdown
-    max_drawdown = drawdowns.min()
+    # Calculate drawdowns, reusing the peaks buffer
+    drawdowns = np.divide(a, previous_peaks, out=previous_peaks)
+    drawdowns -= 1.0
     
-    # Find the date of the maximum drawdown
-    max_drawdown_date = drawdowns.idxmin()
+    # Find the maximum drawdown and its date
+    i = int(drawdowns.argmin())
     
-    return max_drawdown, max_drawdown_date
-def annualize_vol(r, periods_per_year):
-    # Annualizes the volatility (standard deviation) of returns.
-    return r.std() * (periods_per_year ** 0.5)
+    return float(drawdowns[i]), dates[i]
+
+def annualize_vol(r, periods_per_year, moments=None):
+    # Annualizes the volatility (sample standard deviation) of returns.
+    # Pass the result of _moments(r) as moments to rescale its population std instead of another pass.
+    if moments is None:
+        std = r.std(ddof=1)
+    else:
+        n_periods = r.shape[0]
+        # The sample std needs at least two returns, r.std(ddof=1) gives NaN there too
+        if n_periods < 2:
+            return math.nan
+        # Keep a NumPy scalar so a zero volatility divides to inf/NaN downstream, like r.std()
+        std = np.float64(moments[1]) * (n_periods / (n_periods - 1)) ** 0.5
+    return std * (periods_per_year ** 0.5)
 
 def annualize_rets(r, periods_per_year):
     # Annualizes the returns from daily returns, assuming compounding.
-    compounded_growth = (1 + r / 100).prod()
+    # Summing log1p avoids the rounding drift of a long chain of products.
+    compounded_growth = np.exp(np.log1p(np.asarray(r) / 100).sum())
     n_periods = r.shape[0]
     return (compounded_growth ** (periods_per_year / n_periods) - 1) * 100
 
-def sharpe_ratio(r, riskfree_rate, periods_per_year):
+def annualize_rets_from_prices(prices, periods_per_year):
+    # Annualizes the returns straight from the first and last prices.
+    # Compounding the daily returns telescopes to this ratio, so no pass over the series is needed.
+    compounded_growth = float(prices[-1]) / float(prices[0])
+    n_periods = prices.shape[0] - 1
+    return (compounded_growth ** (periods_per_year / n_periods) - 1) * 100
+
+def sharpe_ratio(r, riskfree_rate, ann_vol, periods_per_year):
     # Calculates the Sharpe Ratio, adjusting for the risk-free rate.
+    # ann_vol is the annualized volatility of r, as returned by annualize_vol.
     rf_per_period = ((1 + riskfree_rate / 100) ** (1 / periods_per_year) - 1) * 100
     excess_ret = r - rf_per_period
     ann_ex_ret = annualize_rets(excess_ret, periods_per_year)
-    ann_vol = annualize_vol(r, periods_per_year)
     return ann_ex_ret / ann_vol
 
-def get_annual_risk_free_rate():
+def download_annual_risk_free_rate():
     # Retrieves and annualizes the risk-free rate from the 13-week T-bill index.
+    # Runs in a background thread, so use Ticker.history rather than yf.download,
+    # which keeps shared global state and prints a progress bar over the prompts.
     ticker = '^IRX'
     period = '10y'
-    prices = yf.download(ticker, period=period)
+    prices = yf.Ticker(ticker).history(period=period)
     average_rate = prices['Close'].mean()
     annual_risk_free_rate = average_rate * 252 / 100
-    return annual_risk_free_rate
+    return float(annual_risk_free_rate)
+
+def get_annual_risk_free_rate():
+    # The rate only moves once a trading day, so cache the rate itself rather than 10 years of history.
+    return load_cached("irx", download_annual_risk_free_rate)
 
 
 def main():
     init()
     print_banner()
 
+    # The risk-free rate does not depend on user input, so fetch it in the background
+    # while the user is prompted and the ticker history downloads.
+    risk_free_future = run_in_background(get_annual_risk_free_rate)
+
     ticker = input("Enter the stock ticker symbol: ")
-    prices, period = get_valid_data(ticker)
+    close_prices, period = fetch_stock_data(ticker)
     
-    start_date = prices.index[0].strftime('%Y-%m-%d')
-    end_date = prices.index[-1].strftime('%Y-%m-%d')
+    start_date = close_prices.index[0].strftime('%Y-%m-%d')
+    end_date = close_prices.index[-1].strftime('%Y-%m-%d')
     
-    close_prices = fetch_stock_data(prices)
-    total_return = calculate_total_return(close_prices)
-    daily_returns = get_daily_returns(close_prices)
-    volatility = standard_deviation(daily_returns)
+    # Convert once, every metric below works on the raw arrays
+    close = close_prices.to_numpy(dtype=METRICS_DTYPE)
+    dates = close_prices.index
+    total_return = calculate_total_return(close)
+    daily_returns = get_daily_returns(close)
+    # Computed once, shared by the volatilities and the Cornish-Fisher VaR
+    moments = _moments(daily_returns)
+    volatility = moments[1]
     level = get_level()
     
-    var_hist = var_historic(daily_returns, level)
-    cvar_hist = cvar_historic(daily_returns, level)
-    var_cornish = var_cornishfisher(daily_returns, level)
-    max_drawdown, drawdown_date = get_max_drawdown(close_prices)
+    # Sort once, both historic measures are then lookups into the sorted returns
+    sorted_returns = np.sort(daily_returns)
+    var_hist = var_historic_sorted(sorted_returns, level)
+    cvar_hist = cvar_historic_sorted(sorted_returns, level)
+    var_cornish = var_cornishfisher(daily_returns, level, moments)
+    max_drawdown, drawdown_date = get_max_drawdown(close, dates)
 
     periods_per_year = 252
-    annualized_returns = annualize_rets(daily_returns, periods_per_year)
-    annualized_vol = annualize_vol(daily_returns, periods_per_year)
+    annualized_returns = annualize_rets_from_prices(close, periods_per_year)
+    annualized_vol = annualize_vol(daily_returns, periods_per_year, moments)
     returns_vol_ratio = annualized_returns / annualized_vol
 
-    annual_risk_free_rate = get_annual_risk_free_rate()
+    annual_risk_free_rate = risk_free_future.result()
     excess_returns = annualized_returns - annual_risk_free_rate
-    sharpe = sharpe_ratio(daily_returns, annual_risk_free_rate, periods_per_year)
+    sharpe = sharpe_ratio(daily_returns, annual_risk_free_rate, annualized_vol, periods_per_year)
     
     print(f"\nThe data used started in: {start_date} up to {end_date}")
     print(f"Total Returns: {total_return:.4f}%")